@@ -1,12 +1,23 @@
 import streamlit as st
 import os
 import tempfile
-import shutil
+import asyncio
+import diskcache
+import hashlib
+import json
 import openai
 import re
 import logging
-from babelfish import Language
-from subliminal import download_best_subtitles, scan_video
+import textwrap
+import queue
+import threading
+import types
+import tiktoken
+import time
+import zstandard as zstd
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
@@ -19,19 +30,6 @@ else:
 # Load environment variables
 load_dotenv()
 
-# Import supported providers
-import subliminal.providers.opensubtitles
-import subliminal.providers.podnapisi
-import subliminal.providers.addic7ed
-
-# Configure Subliminal's cache
-from subliminal.cache import region
-try:
-    region.configure('dogpile.cache.memory', expiration_time=timedelta(hours=24), replace_existing_backend=True)
-    logging.debug("Subliminal cache configured successfully.")
-except ValueError:
-    logging.debug("Subliminal cache was already configured.")
-
 # Supported languages
 LANGUAGES = {
     'eng': 'English',
@@ -48,121 +46,615 @@ OPEN_SUBTITLES_USERNAME = os.getenv("OPEN_SUBTITLES_USERNAME")
 OPEN_SUBTITLES_PASSWORD = os.getenv("OPEN_SUBTITLES_PASSWORD")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "deepseek/deepseek-r1-zero:free")
+ENHANCED_CACHE_DIR = os.getenv(
+    "ENHANCED_CACHE_DIR", os.path.join(tempfile.gettempdir(), "subtitle-enhanced-cache")
+)
+
+# How long enhanced subtitles are kept on disk
+ENHANCED_CACHE_TTL = timedelta(days=7)
+
+# Subtitle text compresses well, so cached and session copies are kept as zstd frames
+CCTX = zstd.ZstdCompressor(level=9)
+DCTX = zstd.ZstdDecompressor()
+
+# A typical SRT block starts with its cue number on a line of its own
+SRT_BLOCK_RE = re.compile(r'^\d+\s*\n')
+PROMPT_TEMPLATE = textwrap.dedent("""
+    Enhance the following subtitle text to improve naturalness, fluency, and clarity while preserving the original meaning.
+    IMPORTANT: Return only the SRT-formatted subtitles exactly as requested (with timing codes and numbering) and do not include any extra explanation or text.
+
+    {content}
+
+    Provide the result in SRT format.
+""")
+BATCH_PROMPT_TEMPLATE = textwrap.dedent("""
+    Enhance each subtitle below to improve naturalness, fluency, and clarity while preserving the original meaning.
+    The input is a JSON object mapping language codes to SRT-formatted subtitles.
+    IMPORTANT: Return only strict JSON with the same keys, each mapped to the enhanced SRT subtitles (with timing codes and numbering), and do not include any extra explanation or text.
+
+    {content}
+""")
+# Rate-limit reset durations look like "1s", "6m0s" or "250ms"
+RATE_LIMIT_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+# Refresh the streaming preview every N received chunks
+STREAM_REFRESH_CHUNKS = 20
+# SRT cues are separated by blank lines
+SRT_CUE_SEPARATOR_RE = re.compile(r'\n[ \t]*\n')
+# Subtitle tokens sent in a single enhancement request. The reply is about as
+# long, so prompt and reply together stay inside MODEL_CONTEXT_TOKENS
+SRT_CHUNK_TOKENS = 1500
+# Languages are enhanced in one combined request while their total size stays under this
+BATCH_MAX_TOKENS = SRT_CHUNK_TOKENS
+# Maximum number of OpenRouter requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+# Context window assumed when sizing the completion budget
+MODEL_CONTEXT_TOKENS = 4096
+# Never request fewer completion tokens than this
+MIN_COMPLETION_TOKENS = 256
+# Threads used to query subtitle providers in parallel
+MAX_PROVIDER_WORKERS = 8
+
 
+def compress_text(text):
+    """Compress subtitle text into a zstd frame."""
+    return CCTX.compress(text.encode("utf-8"))
 
+
+def decompress_text(data):
+    """Inverse of :func:`compress_text`."""
+    return DCTX.decompress(data).decode("utf-8")
+
+
+class NoSubtitlesFound(Exception):
+    """Raised when a search finds nothing, so the empty result is not cached."""
+
+
+@st.cache_resource(show_spinner=False)
+def _load_subliminal():
+    """Import Subliminal, its providers and babelfish, and configure its cache.
+
+    Deferred to the first search so app start-up and reruns that never search
+    don't pay for the provider imports.
+    """
+    import subliminal.providers.opensubtitles
+    import subliminal.providers.podnapisi
+    import subliminal.providers.addic7ed
+    from babelfish import Language
+    from subliminal import ProviderPool, compute_score
+    from subliminal.cache import region
+    from subliminal.video import Episode, Movie
+
+    # Configure Subliminal's cache
+    try:
+        # A dbm file survives Streamlit reruns and keeps provider metadata out of the process heap
+        region.configure(
+            'dogpile.cache.dbm',
+            expiration_time=timedelta(hours=24),
+            arguments={'filename': os.getenv(
+                "SUBLIMINAL_CACHE_FILE", os.path.join(tempfile.gettempdir(), "subliminal-cache.dbm")
+            )},
+            replace_existing_backend=True
+        )
+        logging.debug("Subliminal cache configured successfully.")
+    except ValueError:
+        logging.debug("Subliminal cache was already configured.")
+
+    return types.SimpleNamespace(
+        Language=Language, ProviderPool=ProviderPool, compute_score=compute_score,
+        Episode=Episode, Movie=Movie
+    )
+
+
+@st.cache_resource
+def get_enhanced_cache():
+    """On-disk cache of enhanced subtitles, shared across sessions and restarts."""
+    return diskcache.Cache(ENHANCED_CACHE_DIR, size_limit=2**30)
+
+
+@st.cache_resource
+def _event_loop():
+    """Long-lived event loop on a background thread.
+
+    Async clients are bound to the loop they first run on, so keeping one loop
+    alive lets the OpenRouter client and its connections be reused.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openrouter-loop", daemon=True).start()
+    return loop
+
+
+@st.cache_resource(show_spinner=False)
+def _rate_limit():
+    """Shared rate-limit state; ``resume_at`` is the monotonic time before which
+    OpenRouter asked us not to send further requests.
+
+    Kept as a resource because main.py runs in a fresh module on every rerun.
+    """
+    return types.SimpleNamespace(resume_at=0.0)
+
+
+@st.cache_resource
+def get_openai():
+    """Shared OpenRouter client, used only on the ``_event_loop`` thread.
+
+    The client's own retries are disabled; ``_create_completion`` retries instead.
+    """
+    return AsyncOpenAI(
+        base_url="https://openrouter.ai/api/v1", api_key=OPENROUTER_API_KEY, max_retries=0
+    )
+
+
+@st.cache_data(ttl=timedelta(hours=24), max_entries=256, show_spinner=False)
 def search_and_download_subtitles(
     title, year, media_type, languages, providers_list,
     season=None, episode=None, provider_configs=None
 ):
-    logging.debug(f"Starting subtitle search for title: {title}, year: {year}, media_type: {media_type}")
-    temp_dir = tempfile.mkdtemp()
-    dummy_path = os.path.join(temp_dir, f"{title}.mkv")
-    logging.debug(f"Temporary directory created: {temp_dir}")
-    
+    """Search and download subtitles, shared across sessions via ``st.cache_data``.
+
+    Returns a plain dict keyed by language code so the result can be pickled
+    by the cache: ``{lang: {"content", "text", "provider", "id", "hearing_impaired"}}``.
+    ``content`` holds the original file and ``text`` its decoded text, both
+    compressed with zstd.
+    """
+    logging.debug("Starting subtitle search for title: %s, year: %s, media_type: %s", title, year, media_type)
     try:
-        # Create dummy file
-        with open(dummy_path, 'wb') as f:
-            f.write(b'dummy')
-        logging.debug(f"Dummy file created at: {dummy_path}")
-        
-        # Scan video and set metadata
-        video = scan_video(dummy_path)
-        video.title = title
-        video.year = year
-        
+        subliminal = _load_subliminal()
+
+        # Build the video from the search metadata; nothing needs to exist on disk
         if media_type == "episode":
-            video.series = title
-            video.season = season
-            video.episode = episode
-            logging.debug(f"Set video metadata for episode: season {season}, episode {episode}")
+            video = subliminal.Episode(f"{title}.mkv", title, season, episode, year=year)
+            logging.debug("Set video metadata for episode: season %s, episode %s", season, episode)
+        else:
+            video = subliminal.Movie(f"{title}.mkv", title, year=year)
         
         # Convert language codes to Language objects
-        language_set = {Language(l) for l in languages}
-        logging.debug(f"Searching subtitles for languages: {languages}")
+        language_set = {subliminal.Language(l) for l in languages}
+        logging.debug("Searching subtitles for languages: %s", languages)
         
-        # Download subtitles using the provided configurations
-        subtitles = download_best_subtitles(
-            [video],
-            language_set,
-            providers=providers_list,
-            provider_configs=provider_configs or {}
-        )
+        # Query every provider concurrently, then download the best per language
+        # One pool per search: providers are not safe to share across sessions,
+        # and a fresh pool logs in again instead of reusing an expired session
+        with subliminal.ProviderPool(providers=providers_list, provider_configs=provider_configs or {}) as pool:
+            # ProviderPool initializes providers lazily, which is not thread-safe
+            for name in providers_list:
+                try:
+                    pool[name]
+                except Exception as e:
+                    logging.error("Failed to initialize provider %s: %s", name, e)
+                    pool.discarded_providers.add(name)
+
+            # A provider instance holds one connection, so each is only used by one thread at a time
+            provider_locks = {name: threading.Lock() for name in providers_list}
+
+            def download_best(candidates):
+                for sub in sorted(candidates, key=lambda s: subliminal.compute_score(s, video), reverse=True):
+                    with provider_locks[sub.provider_name]:
+                        if pool.download_subtitle(sub):
+                            return sub
+                return None
+
+            with ThreadPoolExecutor(max_workers=MAX_PROVIDER_WORKERS) as executor:
+                futures = {
+                    executor.submit(pool.list_subtitles_provider, name, video, language_set): name
+                    for name in providers_list if name not in pool.discarded_providers
+                }
+                candidates_by_lang = {}
+                for future in as_completed(futures):
+                    provider_subtitles = future.result()
+                    # None means the provider failed; discard it as ProviderPool.list_subtitles does
+                    if provider_subtitles is None:
+                        logging.info("Discarding provider %s", futures[future])
+                        pool.discarded_providers.add(futures[future])
+                        continue
+                    for sub in provider_subtitles:
+                        candidates_by_lang.setdefault(sub.language.alpha3, []).append(sub)
+                logging.debug("Candidate subtitles found for languages: %s", list(candidates_by_lang))
+
+                subtitles = [
+                    sub for sub in executor.map(download_best, candidates_by_lang.values())
+                    if sub is not None
+                ]
         logging.debug("Subtitle download completed.")
         
         # Organize results by language code
         results = {}
-        for sub in subtitles.get(video, []):
-            results[sub.language.alpha3] = sub
-            logging.debug(f"Subtitle found: Provider={sub.provider_name}, ID={sub.id}, Language={sub.language.alpha3}")
+        for sub in subtitles:
+            results[sub.language.alpha3] = {
+                "content": CCTX.compress(sub.content),
+                # Decoded once here; Subliminal guesses the encoding (cp1256, gb18030, ...)
+                # and returns "" when it cannot, so only then replace invalid bytes
+                "text": compress_text(sub.text or sub.content.decode("utf-8", errors="replace")),
+                "provider": sub.provider_name,
+                "id": str(sub.id),
+                "hearing_impaired": bool(getattr(sub, 'hearing_impaired', False)),
+            }
+            logging.debug("Subtitle found: Provider=%s, ID=%s, Language=%s", sub.provider_name, sub.id, sub.language.alpha3)
         
+        # Providers swallow their own errors, so an empty result may be an outage;
+        # raising keeps st.cache_data from serving it to everyone for a day
+        if not results:
+            raise NoSubtitlesFound(title)
         return results
+    except NoSubtitlesFound:
+        raise
     except Exception as e:
-        logging.error(f"Error in search_and_download_subtitles: {str(e)}")
+        logging.error("Error in search_and_download_subtitles: %s", e)
         raise
-    finally:
-        shutil.rmtree(temp_dir)
-        logging.debug(f"Temporary directory {temp_dir} removed.")
 
 
-def enhance_subtitles(sub_content):
-    """Enhance subtitles using OpenAI's API."""
-    if not OPENROUTER_API_KEY:
-        st.error("Missing OpenAI API key. Please set the OPENROUTER_API_KEY environment variable.")
-        logging.error("OPENROUTER_API_KEY not found.")
-        return None
-    
-    openai.base_url = "https://openrouter.ai/api/v1"
+def split_srt(text, max_tokens=SRT_CHUNK_TOKENS):
+    """Split SRT text into chunks of whole cues, each at most ``max_tokens`` long.
 
-    openai.api_key = OPENROUTER_API_KEY
+    A single cue longer than ``max_tokens`` becomes a chunk of its own.
+    """
+    cues = [cue.strip() for cue in SRT_CUE_SEPARATOR_RE.split(text.replace('\r\n', '\n')) if cue.strip()]
+    chunks = []
+    current = []
+    size = 0
+    for cue in cues:
+        cue_tokens = count_tokens(cue) + 2
+        if current and size + cue_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current = []
+            size = 0
+        current.append(cue)
+        size += cue_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def join_srt(chunks):
+    """Concatenate SRT chunks, renumbering the cues sequentially."""
+    cues = [cue.strip() for chunk in chunks for cue in SRT_CUE_SEPARATOR_RE.split(chunk) if cue.strip()]
+    renumbered = []
+    for index, cue in enumerate(cues, start=1):
+        lines = cue.split("\n")
+        if lines[0].strip().isdigit():
+            lines[0] = str(index)
+        renumbered.append("\n".join(lines))
+    return "\n\n".join(renumbered) + "\n"
+
+
+@st.cache_resource(show_spinner=False)
+def _token_encoding():
+    """Load the tokenizer once per process; None if tiktoken cannot fetch it.
+
+    tiktoken downloads the encoding without a timeout, so this must first be
+    called on the script thread, never on the ``_event_loop`` thread.
+    """
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning("Tokenizer unavailable, counting one token per character: %s", e)
+        return None
 
-    prompt = f"""
-Enhance the following subtitle text to improve naturalness, fluency, and clarity while preserving the original meaning.
-IMPORTANT: Return only the SRT-formatted subtitles exactly as requested (with timing codes and numbering) and do not include any extra explanation or text.
 
-{sub_content}
+def count_tokens(text):
+    """Count tokens in ``text``; without a tokenizer every character counts as one.
 
-Provide the result in SRT format.
+    Over-counting only makes chunks smaller and budgets larger, which is safe.
     """
-    logging.debug(f"Enhancement prompt prepared: {prompt[:100]}...")  # log first 100 chars of prompt
+    encoding = _token_encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def completion_budget(prompt):
+    """Size ``max_tokens`` to the prompt: roughly its length, within the context window."""
+    prompt_tokens = count_tokens(prompt)
+    return max(
+        MIN_COMPLETION_TOKENS,
+        min(MODEL_CONTEXT_TOKENS - prompt_tokens - 64, int(prompt_tokens * 1.2))
+    )
+
+
+def parse_time_left(value):
+    """Convert a rate-limit reset duration such as ``"6m0s"`` to seconds."""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in RATE_LIMIT_DURATION_RE.findall(value or ""))
+
+
+@retry(
+    retry=retry_if_exception_type((
+        openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError
+    )),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _create_completion(client, **kwargs):
+    """Create a chat completion, backing off on rate limits and transient errors."""
+    rate_limit = _rate_limit()
+
+    delay = rate_limit.resume_at - time.monotonic()
+    if delay > 0:
+        logging.info("Rate limit exhausted, waiting %.1fs before the next request.", delay)
+        await asyncio.sleep(delay)
 
+    raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+    if raw_response.headers.get("x-ratelimit-remaining-requests") == "0":
+        reset = parse_time_left(raw_response.headers.get("x-ratelimit-reset-requests"))
+        rate_limit.resume_at = max(rate_limit.resume_at, time.monotonic() + reset)
+        logging.warning("OpenRouter request quota exhausted, pausing for %.1fs.", reset)
+    return raw_response.parse()
+
+
+async def _gather_or_cancel(coros):
+    """Like ``asyncio.gather``, but cancels the remaining tasks once one fails.
+
+    Otherwise sibling chunks keep streaming (and spending tokens) for a result
+    that is thrown away.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
     try:
-        response = openai.chat.completions.create(
-            model=OPENROUTER_MODEL,
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def _enhance_one(client, semaphore, sub_content, model, on_update=None):
+    """Enhance a single subtitle chunk, passing partial output to ``on_update``."""
+    prompt = PROMPT_TEMPLATE.format(content=sub_content)
+    logging.debug("Enhancement prompt prepared: %.100s...", prompt)  # log first 100 chars of prompt
+
+    async with semaphore:
+        stream = await _create_completion(
+            client,
+            model=model,
             messages=[
                 {"role": "system", "content": "You are a professional subtitle translator and editor."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=3000
+            max_tokens=completion_budget(prompt),
+            stream=True
         )
 
-        # enhanced_subtitles = response.choices[0].message.content.strip()
-        enhanced_subtitles = response.strip()
+        buf = ""
+        received = 0
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if not chunk.choices[0].delta.content:
+                continue
+            buf += chunk.choices[0].delta.content
+            received += 1
+            if on_update is not None and received % STREAM_REFRESH_CHUNKS == 0:
+                on_update(buf)
 
-        logging.debug("Received response from OpenAI API.")
-        # Validate using a regex to check for a typical SRT block (number followed by a newline)
-        # if not re.match(r'^\d+\s*\n', enhanced_subtitles):
-        #     st.error("Invalid subtitle format returned by AI")
-        #     logging.error("Enhanced subtitles failed validation. Format is not a valid SRT.")
-        #     return None
-        
-        logging.debug("Enhanced subtitles validated successfully.")
-        print(enhanced_subtitles)
-        return enhanced_subtitles
+    # A truncated reply can still look like valid SRT, so it must not be kept
+    if finish_reason == "length":
+        logging.error("Enhanced subtitles were cut off at the token limit.")
+        raise ValueError("AI response was cut off at the token limit")
+
+    # Models often pad the reply with blank lines, which would fail validation
+    enhanced_subtitles = buf.strip()
+
+    logging.debug("Received response from OpenAI API.")
+    # Validate using a regex to check for a typical SRT block (number followed by a newline)
+    if not SRT_BLOCK_RE.match(enhanced_subtitles):
+        logging.error("Enhanced subtitles failed validation. Format is not a valid SRT.")
+        raise ValueError("Invalid subtitle format returned by AI")
+
+    logging.debug("Enhanced subtitles validated successfully.")
+    return enhanced_subtitles
+
+
+async def _enhance_language(client, semaphore, sub_content, model, on_update=None):
+    """Enhance a whole subtitle file as cue-aligned chunks processed concurrently."""
+    chunks = split_srt(sub_content)
+    partial = [""] * len(chunks)
+    logging.debug("Subtitle split into %d chunk(s) for enhancement.", len(chunks))
+
+    def progress(index):
+        def update(buf):
+            partial[index] = buf
+            on_update("\n\n".join(p for p in partial if p))
+        return update
+
+    enhanced = await _gather_or_cancel([
+        _enhance_one(client, semaphore, chunk, model, progress(i) if on_update is not None else None)
+        for i, chunk in enumerate(chunks)
+    ])
+    return join_srt(enhanced)
+
+
+async def _enhance_batch(client, contents, model):
+    """Enhance every language's subtitles with a single JSON-mode completion."""
+    prompt = BATCH_PROMPT_TEMPLATE.format(content=json.dumps(contents, ensure_ascii=False))
+    logging.debug("Batch enhancement prompt prepared: %.100s...", prompt)  # log first 100 chars of prompt
+
+    response = await _create_completion(
+        client,
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are a professional subtitle translator and editor."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=completion_budget(prompt),
+        response_format={"type": "json_object"}
+    )
+
+    if response.choices[0].finish_reason == "length":
+        raise ValueError("Batch response was cut off at the token limit")
+    content = response.choices[0].message.content
+    if not content:
+        raise ValueError("Empty response returned by AI")
+    enhanced = json.loads(content)
+    if not isinstance(enhanced, dict) or set(enhanced) != set(contents):
+        raise ValueError("Batch response does not cover the requested languages")
+    if not all(isinstance(text, str) for text in enhanced.values()):
+        raise ValueError("Invalid subtitle format returned by AI")
+    enhanced = {lang: text.strip() for lang, text in enhanced.items()}
+    if not all(SRT_BLOCK_RE.match(text) for text in enhanced.values()):
+        raise ValueError("Invalid subtitle format returned by AI")
+
+    logging.debug("Batch enhancement validated successfully.")
+    return [enhanced[lang] for lang in contents]
+
+
+async def _enhance_all(client, contents, model, updates=None):
+    """Enhance all subtitle texts, batched into one request when they are small.
+
+    Larger texts are fanned out to OpenRouter concurrently. Partial output is put on ``updates`` as ``(lang, text)`` pairs.
+    """
+    if len(contents) > 1 and count_tokens(json.dumps(contents, ensure_ascii=False)) <= BATCH_MAX_TOKENS:
+        try:
+            return await _enhance_batch(client, contents, model)
+        # Some models or providers reject JSON mode outright; fall back in that case too
+        except (ValueError, openai.BadRequestError) as e:
+            logging.warning("Batch enhancement failed, enhancing languages separately: %s", e)
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return await _gather_or_cancel([
+        _enhance_language(
+            client, semaphore, content, model,
+            (lambda text, lang=lang: updates.put((lang, text))) if updates is not None else None
+        )
+        for lang, content in contents.items()
+    ])
+
+
+def enhance_subtitles(contents, placeholders=None):
+    """Enhance subtitles using OpenAI's API.
+
+    ``contents`` maps language codes to subtitle text; the enhanced texts are
+    returned under the same keys, or None on error. Partial output is streamed
+    into the matching ``st.empty()`` from ``placeholders`` as it arrives.
+    """
+    if not OPENROUTER_API_KEY:
+        st.error("Missing OpenAI API key. Please set the OPENROUTER_API_KEY environment variable.")
+        logging.error("OPENROUTER_API_KEY not found.")
+        return None
+
+    # Subtitles already enhanced with this model are served from the disk cache
+    cache = get_enhanced_cache()
+    keys = {
+        lang: hashlib.sha256(text.encode("utf-8")).hexdigest() + ":" + OPENROUTER_MODEL
+        for lang, text in contents.items()
+    }
+    results = {}
+    for lang, key in keys.items():
+        hit = cache.get(key)
+        if hit is not None:
+            results[lang] = decompress_text(hit)
+    # Providers sometimes return the same text for several languages; enhance it once
+    sharing = {}
+    for lang in contents:
+        if lang not in results:
+            sharing.setdefault(keys[lang], []).append(lang)
+    missing = {langs[0]: contents[langs[0]] for langs in sharing.values()}
+    logging.debug("Enhancement cache hits: %s, misses: %s", list(results), list(missing))
+    if not missing:
+        return results
+
+    # Load the tokenizer here, not on the event loop where its download would stall every request
+    _token_encoding()
+    placeholders = placeholders or {}
+    updates = queue.SimpleQueue()
+    future = asyncio.run_coroutine_threadsafe(
+        _enhance_all(get_openai(), missing, OPENROUTER_MODEL, updates), _event_loop()
+    )
+    try:
+        # Streamlit elements may only be updated from the script thread
+        while not future.done():
+            latest = {}
+            while not updates.empty():
+                lang, text = updates.get()
+                latest[lang] = text
+            for lang, text in latest.items():
+                for shared_lang in sharing[keys[lang]]:
+                    if shared_lang in placeholders:
+                        placeholders[shared_lang].code(text, language=None)
+            time.sleep(0.1)
+        for lang, enhanced in zip(missing, future.result()):
+            cache.set(keys[lang], compress_text(enhanced), expire=ENHANCED_CACHE_TTL.total_seconds())
+            for shared_lang in sharing[keys[lang]]:
+                results[shared_lang] = enhanced
+        return {lang: results[lang] for lang in contents}
     except Exception as e:
         st.error(f"AI Enhancement Error: {str(e)}")
-        logging.error(f"Error in enhance_subtitles: {str(e)}")
+        logging.error("Error in enhance_subtitles: %s", e)
         return None
+    finally:
+        # Stops in-flight requests if the script run is interrupted
+        future.cancel()
+
+
+@st.fragment
+def render_language_card(lang, sub, title):
+    """Render one language's subtitle with its download and enhancement controls."""
+    logging.debug("Displaying subtitle for language: %s", lang)
+    with st.container():
+        st.markdown('<div class="subtitle-box">', unsafe_allow_html=True)
+        st.markdown(f"**{LANGUAGES[lang]} Subtitle**")
+        st.write(f"- Provider: {sub['provider']}")
+        st.write(f"- ID: {sub['id']}")
+        st.write(f"- Closed Captions: {sub['hearing_impaired']}")
+
+        # Download original subtitle file
+        filename = f"{title}.{lang}.srt"
+        st.download_button(
+            "Download Original",
+            data=DCTX.decompress(sub['content']),
+            file_name=filename,
+            mime="text/plain"
+        )
+
+        # Button to enhance this subtitle with AI
+        if st.button("Enhance with AI", key=f"enhance_{lang}"):
+            logging.info("Enhance button clicked for language: %s", lang)
+            placeholder = st.empty()
+            with st.spinner("Processing with AI..."):
+                enhanced = enhance_subtitles({lang: decompress_text(sub['text'])}, {lang: placeholder})
+            placeholder.empty()
+            if enhanced:
+                st.session_state.enhanced_subtitles.update(
+                    {lang: compress_text(text) for lang, text in enhanced.items()}
+                )
+                st.success("AI enhancement completed successfully!")
+                logging.info("AI enhancement completed successfully.")
+            else:
+                st.error("AI enhancement failed. Please try again.")
+                logging.error("AI enhancement failed.")
+
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # Display the enhanced subtitle if available
+    if lang in st.session_state.enhanced_subtitles:
+        with st.container():
+            st.markdown('<div class="enhancement-box">', unsafe_allow_html=True)
+            st.subheader(f"Enhanced {LANGUAGES[lang]} Subtitle")
+            enhanced_text = decompress_text(st.session_state.enhanced_subtitles[lang])
+            st.text_area(f"Improved {LANGUAGES[lang]} Subtitles", value=enhanced_text, height=300)
+            st.download_button(
+                "Download Enhanced",
+                data=enhanced_text,
+                file_name=f"{title}.{lang}_enhanced.srt",
+                mime="text/plain"
+            )
+            # Removed in a callback so the card rerun no longer shows it
+            st.button(
+                "Hide Enhanced",
+                key=f"hide_{lang}",
+                on_click=st.session_state.enhanced_subtitles.pop,
+                args=(lang, None)
+            )
+            st.markdown('</div>', unsafe_allow_html=True)
 
 
 def main():
     st.title("Subtitle Downloader and Enhancer")
     st.write("⚠️ Note: Requires valid provider credentials for some services.")
     
-    # Initialize session state for caching search results and enhanced subtitles
-    if 'search_cache' not in st.session_state:
-        st.session_state.search_cache = {}
-        logging.debug("Initialized session_state.search_cache.")
+    # Initialize session state for enhanced subtitles
     if 'enhanced_subtitles' not in st.session_state:
         st.session_state.enhanced_subtitles = {}
         logging.debug("Initialized session_state.enhanced_subtitles.")
@@ -209,117 +701,85 @@ def main():
             st.error("Please fill all required fields")
             logging.warning("Search attempted with missing fields.")
         else:
-            cache_key = f"{title}_{media_type}_{year}_{'_'.join(selected_langs)}_{'_'.join(selected_providers)}"
-            if media_type == "episode":
-                cache_key += f"_{season}_{episode}"
-            logging.debug(f"Cache key generated: {cache_key}")
-            
-            # Use cache if available, otherwise perform the search
-            if cache_key in st.session_state.search_cache:
-                results = st.session_state.search_cache[cache_key]
-                logging.debug("Using cached search results.")
-            else:
-                try:
-                    with st.spinner("Searching subtitles..."):
-                        season_num = season if media_type == "episode" else None
-                        episode_num = episode if media_type == "episode" else None
-                        results = search_and_download_subtitles(
-                            title, year, media_type, selected_langs,
-                            selected_providers, season=season_num,
-                            episode=episode_num, provider_configs=provider_configs
-                        )
-                        st.session_state.search_cache[cache_key] = results
-                        logging.debug("Search results cached.")
-                except Exception as e:
-                    st.error(f"Error: {str(e)}")
-                    logging.error(f"Error during subtitle search: {str(e)}")
-                    results = {}
-            
-            if not results:
-                st.warning("No subtitles found")
-                logging.info("No subtitles were found for the search criteria.")
-            else:
-                st.subheader("Search Results:")
-                st.markdown("""
-                <style>
-                .subtitle-box {
-                    background-color: #f0f2f6;
-                    border-radius: 10px;
-                    padding: 15px;
-                    margin: 10px 0;
-                    border: 1px solid #ddd;
-                }
-                .enhancement-box {
-                    background-color: #e8f5e9;
-                    border-radius: 10px;
-                    padding: 15px;
-                    margin: 10px 0;
-                    border: 1px solid #93c47d;
-                }
-                </style>
-                """, unsafe_allow_html=True)
-                
-                # Iterate over selected languages and display results
-                for lang in selected_langs:
-                    if lang in results:
-                        sub = results[lang]
-                        logging.debug(f"Displaying subtitle for language: {lang}")
-                        with st.container():
-                            st.markdown('<div class="subtitle-box">', unsafe_allow_html=True)
-                            st.markdown(f"**{LANGUAGES[lang]} Subtitle**")
-                            st.write(f"- Provider: {sub.provider_name}")
-                            st.write(f"- ID: {sub.id}")
-                            if hasattr(sub, 'hearing_impaired'):
-                                st.write(f"- Closed Captions: {sub.hearing_impaired}")
-                            
-                            # Download original subtitle file
-                            filename = f"{title}.{lang}.srt"
-                            st.download_button(
-                                "Download Original",
-                                data=sub.content,
-                                file_name=filename,
-                                mime="text/plain"
-                            )
-                            
-                            def Button_to_enhance_subtitle_with_AI():
-                                logging.info(f"Enhance button clicked for language: {lang}")
-                                with st.spinner("Processing with AI..."):
-                                    enhanced = enhance_subtitles(sub.content.decode('utf-8'))
-                                    if enhanced:
-                                        st.session_state.enhanced_subtitles[lang] = enhanced
-                                        st.success("AI enhancement completed successfully!")
-                                        logging.info("AI enhancement completed successfully.")
-                                    else:
-                                        st.error("AI enhancement failed. Please try again.")
-                                        logging.error("AI enhancement failed.")
-                            
-                            # Button to enhance subtitle with AI
-                            st.button(
-                                label=f"Enhance with AI",
-                                key=f"enhance_{lang}",
-                                on_click=Button_to_enhance_subtitle_with_AI
-                            )
-
-                            st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        # Display the enhanced subtitle if available
-                        if lang in st.session_state.enhanced_subtitles:
-                            with st.container():
-                                st.markdown('<div class="enhancement-box">', unsafe_allow_html=True)
-                                st.subheader(f"Enhanced {LANGUAGES[lang]} Subtitle")
-                                enhanced_text = st.session_state.enhanced_subtitles[lang]
-                                st.text_area("Improved Subtitles", value=enhanced_text, height=300)
-                                st.download_button(
-                                    "Download Enhanced",
-                                    data=enhanced_text,
-                                    file_name=f"{title}.{lang}_enhanced.srt",
-                                    mime="text/plain"
-                                )
-                                if st.button("Hide Enhanced", key=f"hide_{lang}"):
-                                    del st.session_state.enhanced_subtitles[lang]
-                                    logging.debug(f"Enhanced subtitles hidden for language: {lang}")
-                                st.markdown('</div>', unsafe_allow_html=True)
+            season_num = season if media_type == "episode" else None
+            episode_num = episode if media_type == "episode" else None
+            # Remember the search so results survive reruns triggered by other widgets
+            st.session_state.search_params = dict(
+                title=title, year=year, media_type=media_type,
+                languages=selected_langs, providers_list=selected_providers,
+                season=season_num, episode=episode_num,
+                provider_configs=provider_configs
+            )
+            logging.debug("Search parameters stored in session state.")
+
+    if 'search_params' in st.session_state:
+        params = st.session_state.search_params
+        title = params["title"]
+        selected_langs = params["languages"]
+        try:
+            with st.spinner("Searching subtitles..."):
+                # Results are cached across sessions by search_and_download_subtitles
+                results = search_and_download_subtitles(**params)
+        except NoSubtitlesFound:
+            results = {}
+        except Exception as e:
+            st.error(f"Error: {str(e)}")
+            logging.error("Error during subtitle search: %s", e)
+            results = {}
+
+        if not results:
+            # Failed or empty searches are not cached; forget them so unrelated
+            # widget changes don't query every provider again
+            del st.session_state.search_params
+            st.warning("No subtitles found")
+            logging.info("No subtitles were found for the search criteria.")
+        else:
+            st.subheader("Search Results:")
+            st.markdown("""
+            <style>
+            .subtitle-box {
+                background-color: #f0f2f6;
+                border-radius: 10px;
+                padding: 15px;
+                margin: 10px 0;
+                border: 1px solid #ddd;
+            }
+            .enhancement-box {
+                background-color: #e8f5e9;
+                border-radius: 10px;
+                padding: 15px;
+                margin: 10px 0;
+                border: 1px solid #93c47d;
+            }
+            </style>
+            """, unsafe_allow_html=True)
+
+            # One button enhances every found language concurrently
+            if st.button("Enhance All with AI", key="enhance_all"):
+                langs = [lang for lang in selected_langs if lang in results]
+                logging.info("Enhance All button clicked for languages: %s", langs)
+                placeholders = {lang: st.empty() for lang in langs}
+                with st.spinner("Processing with AI..."):
+                    enhanced = enhance_subtitles(
+                        {lang: decompress_text(results[lang]['text']) for lang in langs},
+                        placeholders
+                    )
+                for placeholder in placeholders.values():
+                    placeholder.empty()
+                if enhanced:
+                    st.session_state.enhanced_subtitles.update(
+                        {lang: compress_text(text) for lang, text in enhanced.items()}
+                    )
+                    st.success("AI enhancement completed successfully!")
+                    logging.info("AI enhancement completed successfully.")
+                else:
+                    st.error("AI enhancement failed. Please try again.")
+                    logging.error("AI enhancement failed.")
 
+            # Each card is a fragment, so its buttons rerun only that card
+            for lang in selected_langs:
+                if lang in results:
+                    render_language_card(lang, results[lang], title)
 
 if __name__ == "__main__":
     main()